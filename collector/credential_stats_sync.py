@@ -5,21 +5,155 @@ Parses per-credential and per-API-key usage statistics from CLIProxy
 Management API and stores aggregated results in Supabase.
 
 Data flow:
-1. Fetch /v0/management/usage    → get details[] with source, auth_index, tokens, failed
+1. Fetch /v0/management/usage    → stream details[] with source, auth_index, tokens, failed
 2. Fetch /v0/management/auth-files → map auth_index to email, provider, name, status
 3. Aggregate by credential (auth_index) and by API key
 4. Upsert to credential_usage_summary table (single-row, JSONB)
 """
 
+import hashlib
+import json
 import logging
+import ijson
 import requests
-from typing import Dict, List, Optional, Any
+from urllib3.util.retry import Retry
+from typing import Dict, List, NamedTuple, Optional, Tuple, Any
 from datetime import datetime, timezone
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
+
+from keepalive import KeepAliveHTTPAdapter
+from db_retry import execute_with_retry, CircuitOpenError
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
 
 logger = logging.getLogger(__name__)
 
 
+class CredInfo(NamedTuple):
+    """Credential identity shared by the auth_index and name lookup maps."""
+    provider: str
+    email: str
+    name: str
+    label: str
+    status: str
+    account_type: str
+    auth_index: str
+
+
+class _Counters:
+    """Base for slot-based accumulators: every slot listed in _COUNTERS starts at 0."""
+    __slots__ = ()
+    _COUNTERS: tuple = ()
+
+    def __init__(self):
+        for name in self._COUNTERS:
+            setattr(self, name, 0)
+
+
+class CredAgg(_Counters):
+    """Running totals for one credential."""
+    _COUNTERS = (
+        'total_requests', 'success_count', 'failure_count',
+        'input_tokens', 'output_tokens', 'reasoning_tokens',
+        'cached_tokens', 'total_tokens',
+    )
+    __slots__ = _COUNTERS + ('models', 'api_keys_mask', 'bit', 'info')
+
+    def __init__(self, bit: int):
+        super().__init__()
+        # model_name -> counters, already in the stored JSON shape
+        self.models: Dict[str, Dict[str, int]] = {}
+        # Bitmap of API key ids (see ApiKeyAgg.bit) that used this credential
+        self.api_keys_mask = 0
+        self.bit = bit
+        self.info = None
+
+
+class ApiKeyAgg(_Counters):
+    """Running totals for one API key."""
+    _COUNTERS = (
+        'total_requests', 'total_tokens',
+        'success_count', 'failure_count',
+        'input_tokens', 'output_tokens',
+    )
+    __slots__ = _COUNTERS + ('models', 'credentials_mask', 'bit')
+
+    def __init__(self, bit: int):
+        super().__init__()
+        # model_name -> counters, already in the stored JSON shape
+        self.models: Dict[str, Dict[str, int]] = {}
+        # Bitmap of credential ids (see CredAgg.bit) used by this API key
+        self.credentials_mask = 0
+        self.bit = bit
+
+
+def _names_from_mask(mask: int, names: List[str]) -> List[str]:
+    """Expand a bitmap of ids back into the names they were assigned to."""
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(names[low.bit_length() - 1])
+        mask ^= low
+    return out
+
+
+# Returned by fetch_auth_files on 304 Not Modified
+USE_CACHED = object()
+
+_TOK_KEYS = ('input_tokens', 'output_tokens', 'reasoning_tokens', 'cached_tokens', 'total_tokens')
+_get_token_counts = itemgetter(*_TOK_KEYS)
+
+_GEMINI_KEY_PREFIXES = ('aizasy',)
+
+
+@lru_cache(maxsize=4096)
+def _infer_credential(auth_index: str, source: str) -> CredInfo:
+    """
+    Infer credential info from a raw source string when it is not in auth-files.
+    Results are cached across syncs.
+    """
+    provider = 'unknown'
+    email = source or auth_index or 'unknown'
+
+    if source:
+        s = source.lower()
+        if s.startswith(_GEMINI_KEY_PREFIXES) or 'googleapis' in s:
+            provider = 'gemini-api-key'
+            email = source[:20] + '...'
+        elif s.endswith('.json'):
+            # Try to extract provider-email pattern
+            parts = s.replace('.json', '').split('-', 1)
+            if len(parts) == 2:
+                provider = parts[0]
+                email = parts[1].replace('_', '.')
+        elif '@' in s:
+            email = source
+            provider = 'oauth'
+        elif '=' in s or len(s) > 40:
+            provider = 'api-key'
+            email = source[:20] + '...'
+
+    return CredInfo(
+        provider=provider,
+        email=email,
+        name=source,
+        label=email,
+        status='active',
+        account_type='inferred',
+        auth_index=auth_index,
+    )
+
+
 class CredentialStatsSync:
     """Syncs per-credential usage statistics from CLIProxy."""
 
@@ -28,39 +162,75 @@ class CredentialStatsSync:
         self.management_key = management_key
         self.supabase = supabase_client
 
-    def fetch_usage(self) -> Optional[Dict]:
-        """Fetch usage data from CLIProxy."""
+        # Keep-alive session so both management calls share one TLS connection
+        self._session = requests.Session()
+        adapter = KeepAliveHTTPAdapter(
+            pool_connections=4, pool_maxsize=4,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+        )
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers.update({
+            'Authorization': f'Bearer {management_key}',
+            'X-Management-Key': management_key,
+        })
+
+        # Auth-file lookup maps from the last 200 response, revalidated via ETag
+        self._auth_etag: Optional[str] = None
+        self._auth_maps: Optional[tuple] = None
+
+        # Fingerprint of the last summary payload written to Supabase
+        self._summary_digest: Optional[bytes] = None
+
+    def close(self):
+        """Release pooled connections."""
+        self._session.close()
+
+    def fetch_usage(self) -> Optional[requests.Response]:
+        """
+        Open a streaming request for usage data from CLIProxy.
+        The body is left unread so it can be parsed incrementally;
+        the caller is responsible for closing the response.
+        """
         try:
-            headers = {'Authorization': f'Bearer {self.management_key}'}
-            resp = requests.get(
+            resp = self._session.get(
                 f"{self.cliproxy_url}/v0/management/usage",
-                headers=headers, timeout=30
+                stream=True, timeout=30
             )
             if resp.status_code != 200:
                 logger.error(f"Usage API returned {resp.status_code}")
+                resp.close()
                 return None
-            return resp.json()
+            return resp
         except Exception as e:
             logger.error(f"Failed to fetch usage: {e}")
             return None
 
-    def fetch_auth_files(self) -> Optional[List[Dict]]:
-        """Fetch auth files for credential mapping."""
+    def fetch_auth_files(self):
+        """
+        Fetch auth files for credential mapping.
+        Returns (files, etag), or USE_CACHED when the server confirms the cached maps are still current.
+        """
         try:
-            headers = {'X-Management-Key': self.management_key}
-            resp = requests.get(
+            headers = {}
+            if self._auth_etag and self._auth_maps is not None:
+                headers['If-None-Match'] = self._auth_etag
+            resp = self._session.get(
                 f"{self.cliproxy_url}/v0/management/auth-files",
                 headers=headers, timeout=30
             )
+            if resp.status_code == 304:
+                return USE_CACHED
             if resp.status_code != 200:
                 logger.error(f"Auth files API returned {resp.status_code}")
                 return None
-            return resp.json().get('files', [])
+            # The ETag is only adopted by sync() together with the maps built from these files
+            return _json_loads(resp.content).get('files', []), resp.headers.get('ETag')
         except Exception as e:
             logger.error(f"Failed to fetch auth files: {e}")
             return None
 
-    def build_auth_index_map(self, auth_files: List[Dict]) -> Dict[str, Dict]:
+    def build_auth_index_map(self, auth_files: List[Dict]) -> Tuple[Dict[str, CredInfo], Dict[str, CredInfo]]:
         """
         Build lookup maps from auth files.
         Returns dict keyed by auth_index with credential info.
@@ -70,15 +240,15 @@ class CredentialStatsSync:
         by_name = {}
 
         for f in auth_files:
-            info = {
-                'provider': f.get('provider', ''),
-                'email': f.get('email', ''),
-                'name': f.get('name', ''),
-                'label': f.get('label', ''),
-                'status': f.get('status', 'unknown'),
-                'account_type': f.get('account_type', ''),
-                'auth_index': f.get('auth_index', ''),
-            }
+            info = CredInfo(
+                provider=f.get('provider', ''),
+                email=f.get('email', ''),
+                name=f.get('name', ''),
+                label=f.get('label', ''),
+                status=f.get('status', 'unknown'),
+                account_type=f.get('account_type', ''),
+                auth_index=f.get('auth_index', ''),
+            )
             if f.get('auth_index'):
                 by_auth_index[f['auth_index']] = info
             if f.get('name'):
@@ -87,7 +257,7 @@ class CredentialStatsSync:
         return by_auth_index, by_name
 
     def resolve_credential(self, auth_index: str, source: str,
-                           by_auth_index: Dict, by_name: Dict) -> Dict:
+                           by_auth_index: Dict, by_name: Dict) -> CredInfo:
         """
         Resolve a credential from auth_index and source.
         Try auth_index first, then source (filename), then fallback.
@@ -101,36 +271,7 @@ class CredentialStatsSync:
             return by_name[source]
 
         # Fallback - try to infer from source string
-        provider = 'unknown'
-        email = source or auth_index or 'unknown'
-
-        if source:
-            s = source.lower()
-            if s.startswith('aizasy') or 'googleapis' in s:
-                provider = 'gemini-api-key'
-                email = source[:20] + '...'
-            elif s.endswith('.json'):
-                # Try to extract provider-email pattern
-                parts = s.replace('.json', '').split('-', 1)
-                if len(parts) == 2:
-                    provider = parts[0]
-                    email = parts[1].replace('_', '.')
-            elif '@' in source:
-                email = source
-                provider = 'oauth'
-            elif '=' in source or len(source) > 40:
-                provider = 'api-key'
-                email = source[:20] + '...'
-
-        return {
-            'provider': provider,
-            'email': email,
-            'name': source or '',
-            'label': email,
-            'status': 'active',
-            'account_type': 'inferred',
-            'auth_index': auth_index or '',
-        }
+        return _infer_credential(auth_index or '', source or '')
 
     def aggregate_stats(self, usage_data: Dict, auth_files: List[Dict]) -> tuple:
         """
@@ -139,83 +280,114 @@ class CredentialStatsSync:
         Returns:
             (credential_stats: list, api_key_stats: list)
         """
+        apis = usage_data.get('usage', {}).get('apis', {})
         by_auth_index, by_name = self.build_auth_index_map(auth_files)
+        return self._aggregate(apis.items(), by_auth_index, by_name)
+
+    def aggregate_stats_stream(self, resp: requests.Response,
+                               by_auth_index: Dict, by_name: Dict) -> tuple:
+        """
+        Same as aggregate_stats, but parses the usage response body incrementally
+        against prebuilt auth-file maps.
+        Only one API key's slice of usage.apis is materialized at a time.
+        """
+        resp.raw.decode_content = True
+        api_items = ijson.kvitems(resp.raw, 'usage.apis', use_float=True)
+        return self._aggregate(api_items, by_auth_index, by_name)
+
+    def _aggregate(self, api_items, by_auth_index: Dict, by_name: Dict) -> tuple:
+        """Aggregate (api_key_name, api_data) pairs into serializable stat lists."""
 
         # Per-credential aggregation keyed by auth_index (or source as fallback)
-        cred_agg = defaultdict(lambda: {
-            'total_requests': 0, 'success_count': 0, 'failure_count': 0,
-            'input_tokens': 0, 'output_tokens': 0, 'reasoning_tokens': 0,
-            'cached_tokens': 0, 'total_tokens': 0,
-            'models': defaultdict(lambda: {
-                'requests': 0, 'success': 0, 'failure': 0,
-                'input_tokens': 0, 'output_tokens': 0, 'reasoning_tokens': 0,
-                'cached_tokens': 0, 'total_tokens': 0,
-            }),
-            'api_keys': set(),
-            'info': None,
-        })
+        cred_agg: Dict[str, CredAgg] = {}
 
         # Per-API-key aggregation
-        api_key_agg = defaultdict(lambda: {
-            'total_requests': 0, 'total_tokens': 0,
-            'success_count': 0, 'failure_count': 0,
-            'input_tokens': 0, 'output_tokens': 0,
-            'models': defaultdict(lambda: {
-                'requests': 0, 'tokens': 0,
-                'success': 0, 'failure': 0,
-            }),
-            'credentials_used': set(),
-        })
-
-        apis = usage_data.get('usage', {}).get('apis', {})
+        api_key_agg: Dict[str, ApiKeyAgg] = {}
 
-        for api_key_name, api_data in apis.items():
-            ak = api_key_agg[api_key_name]
+        for api_key_name, api_data in api_items:
+            ak = api_key_agg.get(api_key_name)
+            if ak is None:
+                ak = api_key_agg[api_key_name] = ApiKeyAgg(1 << len(api_key_agg))
 
             for model_name, model_data in api_data.get('models', {}).items():
                 details = model_data.get('details', [])
 
+                # Pass 1: fold each detail into a flat counter row per credential.
+                # Row layout: [requests, success, input, output, reasoning, cached, total]
+                rows = {}
                 for d in details:
                     auth_idx = d.get('auth_index', '')
                     source = d.get('source', '')
-                    failed = d.get('failed', False)
-                    tokens = d.get('tokens', {})
+                    tokens = d.get('tokens')
 
                     # Use auth_index as primary key, source as fallback
                     cred_key = auth_idx or source or 'unknown'
 
-                    # Resolve credential info (only once per key)
-                    cred = cred_agg[cred_key]
-                    if cred['info'] is None:
-                        cred['info'] = self.resolve_credential(
-                            auth_idx, source, by_auth_index, by_name
-                        )
-
-                    # Token values
-                    in_tok = tokens.get('input_tokens', 0)
-                    out_tok = tokens.get('output_tokens', 0)
-                    reason_tok = tokens.get('reasoning_tokens', 0)
-                    cache_tok = tokens.get('cached_tokens', 0)
-                    tot_tok = tokens.get('total_tokens', 0)
+                    row = rows.get(cred_key)
+                    if row is None:
+                        row = rows[cred_key] = [0, 0, 0, 0, 0, 0, 0]
+                        # Resolve credential info (only once per key)
+                        if cred_key not in cred_agg:
+                            cred = cred_agg[cred_key] = CredAgg(1 << len(cred_agg))
+                            cred.info = self.resolve_credential(
+                                auth_idx, source, by_auth_index, by_name
+                            )
+
+                    row[0] += 1
+                    if not d.get('failed', False):
+                        row[1] += 1
+
+                    # Failed requests usually carry no tokens; skip the no-op adds
+                    if not tokens:
+                        continue
+                    try:
+                        tok = _get_token_counts(tokens)
+                    except KeyError:
+                        tok = tuple(tokens.get(k, 0) for k in _TOK_KEYS)
+                    if any(tok):
+                        row[2] += tok[0]
+                        row[3] += tok[1]
+                        row[4] += tok[2]
+                        row[5] += tok[3]
+                        row[6] += tok[4]
+
+                if not rows:
+                    continue
+
+                # Pass 2: roll each (credential, api key, model) row up into
+                # the credential and API key views.
+                ak_model = ak.models.get(model_name)
+                if ak_model is None:
+                    ak_model = ak.models[model_name] = {
+                        'requests': 0, 'tokens': 0, 'success': 0, 'failure': 0,
+                    }
+
+                for cred_key, (reqs, ok, in_tok, out_tok, reason_tok, cache_tok, tot_tok) in rows.items():
+                    failures = reqs - ok
 
                     # Update credential stats
-                    cred['total_requests'] += 1
-                    if failed:
-                        cred['failure_count'] += 1
-                    else:
-                        cred['success_count'] += 1
-                    cred['input_tokens'] += in_tok
-                    cred['output_tokens'] += out_tok
-                    cred['reasoning_tokens'] += reason_tok
-                    cred['cached_tokens'] += cache_tok
-                    cred['total_tokens'] += tot_tok
-                    cred['api_keys'].add(api_key_name)
+                    cred = cred_agg[cred_key]
+                    cred.total_requests += reqs
+                    cred.success_count += ok
+                    cred.failure_count += failures
+                    cred.input_tokens += in_tok
+                    cred.output_tokens += out_tok
+                    cred.reasoning_tokens += reason_tok
+                    cred.cached_tokens += cache_tok
+                    cred.total_tokens += tot_tok
+                    cred.api_keys_mask |= ak.bit
 
                     # Update credential model stats
-                    m = cred['models'][model_name]
-                    m['requests'] += 1
-                    m['success'] += 0 if failed else 1
-                    m['failure'] += 1 if failed else 0
+                    m = cred.models.get(model_name)
+                    if m is None:
+                        m = cred.models[model_name] = {
+                            'requests': 0, 'success': 0, 'failure': 0,
+                            'input_tokens': 0, 'output_tokens': 0, 'reasoning_tokens': 0,
+                            'cached_tokens': 0, 'total_tokens': 0,
+                        }
+                    m['requests'] += reqs
+                    m['success'] += ok
+                    m['failure'] += failures
                     m['input_tokens'] += in_tok
                     m['output_tokens'] += out_tok
                     m['reasoning_tokens'] += reason_tok
@@ -223,52 +395,50 @@ class CredentialStatsSync:
                     m['total_tokens'] += tot_tok
 
                     # Update API key stats
-                    ak['total_requests'] += 1
-                    ak['total_tokens'] += tot_tok
-                    ak['input_tokens'] += in_tok
-                    ak['output_tokens'] += out_tok
-                    if failed:
-                        ak['failure_count'] += 1
-                    else:
-                        ak['success_count'] += 1
-                    ak['credentials_used'].add(cred_key)
-
-                    ak_model = ak['models'][model_name]
-                    ak_model['requests'] += 1
+                    ak.total_requests += reqs
+                    ak.total_tokens += tot_tok
+                    ak.input_tokens += in_tok
+                    ak.output_tokens += out_tok
+                    ak.success_count += ok
+                    ak.failure_count += failures
+                    ak.credentials_mask |= cred.bit
+
+                    ak_model['requests'] += reqs
                     ak_model['tokens'] += tot_tok
-                    ak_model['success'] += 0 if failed else 1
-                    ak_model['failure'] += 1 if failed else 0
+                    ak_model['success'] += ok
+                    ak_model['failure'] += failures
 
         # Convert to serializable lists
+        cred_keys = list(cred_agg)
+        api_key_names = list(api_key_agg)
+
         credential_stats = []
         for cred_key, cred in cred_agg.items():
-            info = cred['info'] or {}
+            info = cred.info
             success_rate = 0
-            if cred['total_requests'] > 0:
+            if cred.total_requests > 0:
                 success_rate = round(
-                    (cred['success_count'] / cred['total_requests']) * 100, 1
+                    (cred.success_count / cred.total_requests) * 100, 1
                 )
             credential_stats.append({
-                'auth_index': info.get('auth_index', cred_key),
-                'source': info.get('name', ''),
-                'provider': info.get('provider', 'unknown'),
-                'email': info.get('email', ''),
-                'label': info.get('label', ''),
-                'status': info.get('status', 'unknown'),
-                'account_type': info.get('account_type', ''),
-                'total_requests': cred['total_requests'],
-                'success_count': cred['success_count'],
-                'failure_count': cred['failure_count'],
+                'auth_index': info.auth_index,
+                'source': info.name,
+                'provider': info.provider,
+                'email': info.email,
+                'label': info.label,
+                'status': info.status,
+                'account_type': info.account_type,
+                'total_requests': cred.total_requests,
+                'success_count': cred.success_count,
+                'failure_count': cred.failure_count,
                 'success_rate': success_rate,
-                'input_tokens': cred['input_tokens'],
-                'output_tokens': cred['output_tokens'],
-                'reasoning_tokens': cred['reasoning_tokens'],
-                'cached_tokens': cred['cached_tokens'],
-                'total_tokens': cred['total_tokens'],
-                'models': {
-                    k: dict(v) for k, v in cred['models'].items()
-                },
-                'api_keys': sorted(cred['api_keys']),
+                'input_tokens': cred.input_tokens,
+                'output_tokens': cred.output_tokens,
+                'reasoning_tokens': cred.reasoning_tokens,
+                'cached_tokens': cred.cached_tokens,
+                'total_tokens': cred.total_tokens,
+                'models': cred.models,
+                'api_keys': sorted(_names_from_mask(cred.api_keys_mask, api_key_names)),
             })
 
         # Sort by total_requests descending
@@ -277,23 +447,21 @@ class CredentialStatsSync:
         api_key_stats = []
         for ak_name, ak in api_key_agg.items():
             success_rate = 0
-            if ak['total_requests'] > 0:
+            if ak.total_requests > 0:
                 success_rate = round(
-                    (ak['success_count'] / ak['total_requests']) * 100, 1
+                    (ak.success_count / ak.total_requests) * 100, 1
                 )
             api_key_stats.append({
                 'api_key_name': ak_name,
-                'total_requests': ak['total_requests'],
-                'total_tokens': ak['total_tokens'],
-                'success_count': ak['success_count'],
-                'failure_count': ak['failure_count'],
+                'total_requests': ak.total_requests,
+                'total_tokens': ak.total_tokens,
+                'success_count': ak.success_count,
+                'failure_count': ak.failure_count,
                 'success_rate': success_rate,
-                'input_tokens': ak['input_tokens'],
-                'output_tokens': ak['output_tokens'],
-                'models': {
-                    k: dict(v) for k, v in ak['models'].items()
-                },
-                'credentials_used': sorted(ak['credentials_used']),
+                'input_tokens': ak.input_tokens,
+                'output_tokens': ak.output_tokens,
+                'models': ak.models,
+                'credentials_used': sorted(_names_from_mask(ak.credentials_mask, cred_keys)),
             })
 
         api_key_stats.sort(key=lambda x: x['total_requests'], reverse=True)
@@ -308,36 +476,73 @@ class CredentialStatsSync:
         stats = {'credentials': 0, 'api_keys': 0, 'error': False}
 
         try:
-            usage_data = self.fetch_usage()
-            if not usage_data:
+            # Both endpoints are independent, so fetch them concurrently
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                usage_future = ex.submit(self.fetch_usage)
+                auth_future = ex.submit(self.fetch_auth_files)
+                usage_resp, auth_files = usage_future.result(), auth_future.result()
+
+            if usage_resp is None:
                 stats['error'] = True
                 return stats
 
-            auth_files = self.fetch_auth_files()
-            if auth_files is None:
-                auth_files = []
+            if auth_files is USE_CACHED:
+                auth_maps = self._auth_maps
+            elif auth_files is not None:
+                files, etag = auth_files
+                auth_maps = self._auth_maps = self.build_auth_index_map(files)
+                self._auth_etag = etag
+            elif self._auth_maps is not None:
+                auth_maps = self._auth_maps
+                logger.warning("Could not fetch auth files, using last known credential mapping")
+            else:
+                auth_maps = ({}, {})
                 logger.warning("Could not fetch auth files, proceeding without credential mapping")
 
-            credential_stats, api_key_stats = self.aggregate_stats(usage_data, auth_files)
+            try:
+                credential_stats, api_key_stats = self.aggregate_stats_stream(usage_resp, *auth_maps)
+            finally:
+                usage_resp.close()
 
             stats['credentials'] = len(credential_stats)
             stats['api_keys'] = len(api_key_stats)
 
-            # Upsert to single-row summary table
-            self.supabase.table('credential_usage_summary').upsert({
-                'id': 1,
-                'credentials': credential_stats,
-                'api_keys': api_key_stats,
-                'total_credentials': len(credential_stats),
-                'total_api_keys': len(api_key_stats),
-                'synced_at': datetime.now(timezone.utc).isoformat(),
-            }, on_conflict='id').execute()
-
-            logger.info(
-                f"Credential stats synced: {stats['credentials']} credentials, "
-                f"{stats['api_keys']} API keys"
-            )
+            synced_at = datetime.now(timezone.utc).isoformat()
+            digest = hashlib.sha1(_json_dumps([credential_stats, api_key_stats])).digest()
+
+            refreshed = False
+            if digest == self._summary_digest:
+                # Nothing changed since the last upload; only bump the timestamp
+                refreshed = bool(execute_with_retry(
+                    self.supabase.table('credential_usage_summary')
+                    .update({'synced_at': synced_at})
+                    .eq('id', 1)
+                ).data)
+                if refreshed:
+                    logger.info("Credential stats unchanged, refreshed synced_at only")
+                else:
+                    logger.warning("Credential summary row missing, re-uploading full stats")
+
+            if not refreshed:
+                # Upsert to single-row summary table
+                execute_with_retry(self.supabase.table('credential_usage_summary').upsert({
+                    'id': 1,
+                    'credentials': credential_stats,
+                    'api_keys': api_key_stats,
+                    'total_credentials': len(credential_stats),
+                    'total_api_keys': len(api_key_stats),
+                    'synced_at': synced_at,
+                }, on_conflict='id'))
+                self._summary_digest = digest
+
+                logger.info(
+                    f"Credential stats synced: {stats['credentials']} credentials, "
+                    f"{stats['api_keys']} API keys"
+                )
 
+        except CircuitOpenError as e:
+            logger.warning(f"Credential stats sync skipped: {e}")
+            stats['error'] = True
         except Exception as e:
             logger.error(f"Credential stats sync failed: {e}", exc_info=True)
             stats['error'] = True
@@ -345,7 +550,20 @@ class CredentialStatsSync:
         return stats
 
 
+_syncer: Optional[CredentialStatsSync] = None
+
 def sync_credential_stats(cliproxy_url: str, management_key: str, supabase_client) -> Dict:
-    """Convenience function."""
-    syncer = CredentialStatsSync(cliproxy_url, management_key, supabase_client)
-    return syncer.sync()
+    """
+    Convenience function.
+    Reuses one syncer across calls so its connection pool and auth-file cache persist.
+    Callers serialize runs (main.py submits it under credential_sync_lock).
+    """
+    global _syncer
+    if (_syncer is None
+            or _syncer.cliproxy_url != cliproxy_url.rstrip('/')
+            or _syncer.management_key != management_key
+            or _syncer.supabase is not supabase_client):
+        if _syncer is not None:
+            _syncer.close()
+        _syncer = CredentialStatsSync(cliproxy_url, management_key, supabase_client)
+    return _syncer.sync()
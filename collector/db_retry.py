@@ -0,0 +1,168 @@
+"""
+Retry helper for Supabase (PostgREST) calls
+
+Transient failures - rate limiting, gateway errors, dropped connections -
+are retried with jittered exponential backoff instead of failing the whole
+sync tick. A process-wide circuit breaker stops calling Supabase for a while
+once calls keep failing after their retries, so an outage is not prolonged
+by retry storms.
+"""
+
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+
+import httpx
+from postgrest.exceptions import APIError
+
+logger = logging.getLogger(__name__)
+
+# Gateway statuses; postgrest-py reports the HTTP status as the error code
+# when the response body is not a PostgREST error
+RETRY_HTTP_STATUSES = {'502', '503', '504'}
+# Failures that guarantee nothing was applied: rate limited, PostgREST could not
+# reach (or was reloading) the database, transaction rolled back on a
+# serialization failure or deadlock
+RETRY_SAFE_CODES = {'429', 'PGRST000', 'PGRST001', 'PGRST002', '40001', '40P01'}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Supabase while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker shared by all Supabase calls.
+
+    Opens after fail_max calls in a row fail with a transient error (after
+    their retries), rejects calls for reset_timeout seconds, then lets a
+    single trial call through: success closes it, failure re-opens it.
+    The collector sets reset_timeout from its poll interval so that whole
+    scheduled ticks are skipped while the breaker is open.
+    """
+
+    def __init__(self, fail_max: int = 5, reset_timeout: float = 60.0):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls are currently being rejected (trial window not reached yet)."""
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(f"Supabase circuit open, retrying in {remaining:.0f}s")
+            if self._trial_running:
+                raise CircuitOpenError("Supabase circuit open, trial call in progress")
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Supabase circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self._failures >= self.fail_max):
+                logger.error(f"Supabase circuit opened after {self._failures} consecutive failures; "
+                             f"pausing calls for {self.reset_timeout:.0f}s")
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+SUPABASE_BREAKER = CircuitBreaker()
+
+# HTTP status and Retry-After of the last Supabase response on this thread.
+# postgrest-py's APIError carries only the body's error code, so the status
+# and headers are captured by an httpx response hook (see record_response).
+_last_response = threading.local()
+
+
+def record_response(response: httpx.Response):
+    """httpx response event hook: remember status and Retry-After for execute_with_retry."""
+    _last_response.status = str(response.status_code)
+    _last_response.retry_after = response.headers.get('Retry-After')
+
+
+def _take_last_response() -> tuple[Optional[str], Optional[str]]:
+    status = getattr(_last_response, 'status', None)
+    retry_after = getattr(_last_response, 'retry_after', None)
+    _last_response.status = _last_response.retry_after = None
+    return status, retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc: Exception, idempotent: bool, status: Optional[str] = None) -> bool:
+    """Whether a failed Supabase call can be repeated; status is the HTTP status when known."""
+    if isinstance(exc, APIError):
+        codes = {str(exc.code), status}
+        return bool(codes & RETRY_SAFE_CODES) or (idempotent and bool(codes & RETRY_HTTP_STATUSES))
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        # The request never reached the server
+        return True
+    return idempotent and isinstance(exc, httpx.TransportError)
+
+
+def execute_with_retry(query: Any, idempotent: bool = True, max_attempts: int = 4,
+                       base_delay: float = 0.5, max_delay: float = 30.0) -> Any:
+    """Run query.execute(), retrying transient failures with jittered exponential backoff.
+
+    Pass idempotent=False for writes that must not be applied twice; those are
+    only retried when the failure guarantees the request was not executed.
+    A Retry-After header stretches the delay; if it asks for more than max_delay
+    the call is not retried.
+    Raises CircuitOpenError without calling Supabase while SUPABASE_BREAKER is open.
+    """
+    SUPABASE_BREAKER.before_call()
+    attempt = 1
+    while True:
+        _take_last_response()
+        try:
+            result = query.execute()
+        except Exception as e:
+            status, retry_after = _take_last_response()
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            delay = max(delay, parse_retry_after(retry_after) or 0.0)
+            if attempt >= max_attempts or delay > max_delay or not is_retryable(e, idempotent, status):
+                # Only outage-like failures count; a bad request says nothing about availability
+                if is_retryable(e, True, status):
+                    SUPABASE_BREAKER.record_failure()
+                else:
+                    SUPABASE_BREAKER.record_success()
+                raise
+            logger.warning(f"Supabase call failed ({e}); retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+        else:
+            SUPABASE_BREAKER.record_success()
+            return result
@@ -0,0 +1,43 @@
+"""
+TCP keep-alive for the collector's pooled HTTP connections
+
+Connections sit idle for a whole polling interval between ticks. NATs, Docker
+bridges and proxies often drop idle TCP flows silently, so the next request
+pays for a fresh handshake (or a retry on a dead socket). Kernel keep-alive
+probes keep the pooled sockets alive and detect dead peers early.
+"""
+
+import socket
+from typing import Optional
+
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+# Start probing after 60s idle, then every 15s; give up after 4 missed probes
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+for _name, _value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4)):
+    # Linux names; other platforms fall back to the system keep-alive timers
+    if hasattr(socket, _name):
+        KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _name), _value))
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled connections enable TCP keep-alive."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', KEEPALIVE_SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def keepalive_httpx_client(timeout: float, keepalive_expiry: float, event_hooks: Optional[dict] = None) -> httpx.Client:
+    """httpx client (as used by supabase-py) that keeps idle pooled connections for keepalive_expiry seconds."""
+    # Pool limits belong to the transport; httpx ignores Client(limits=...) when a transport is given
+    transport = httpx.HTTPTransport(
+        limits=httpx.Limits(max_connections=8, max_keepalive_connections=4, keepalive_expiry=keepalive_expiry),
+        retries=1,
+        socket_options=KEEPALIVE_SOCKET_OPTIONS,
+    )
+    return httpx.Client(timeout=timeout, transport=transport, event_hooks=event_hooks)
@@ -5,31 +5,56 @@ Polls the CLIProxy Management API and stores usage data in Supabase
 """
 
 import os
+import copy
+import gzip
+import json
 import time
+import base64
+import atexit
 import logging
 import threading
 from datetime import datetime, date, timezone, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from pathlib import Path
+from types import MappingProxyType
 
 import requests
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from flask import Flask, jsonify, Blueprint
 from flask_cors import CORS
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from credential_stats_sync import sync_credential_stats
+from keepalive import KeepAliveHTTPAdapter, keepalive_httpx_client
+from db_retry import execute_with_retry, record_response, CircuitOpenError, SUPABASE_BREAKER
 from waitress import serve
 from apscheduler.schedulers.background import BackgroundScheduler
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+# Load .env from project root (parent of collector directory) before any setting is read
+env_path = Path(__file__).parent.parent / '.env'
+if load_dotenv(env_path):
+    print(f"Loaded environment from {env_path}")
+
 # Configurable timezone via environment variable (default: UTC+7 for Vietnam)
 TIMEZONE_OFFSET_HOURS = int(os.environ.get('TIMEZONE_OFFSET_HOURS', '7'))
 APP_TIMEZONE = timezone(timedelta(hours=TIMEZONE_OFFSET_HOURS))
+_TZ_OFFSET_SEC = TIMEZONE_OFFSET_HOURS * 3600
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
-# Load .env from project root (parent of collector directory)
-env_path = Path(__file__).parent.parent / '.env'
-if env_path.exists():
-    load_dotenv(env_path)
-    print(f"Loaded environment from {env_path}")
+def local_today() -> date:
+    """Current date in APP_TIMEZONE, from the epoch clock without tzinfo calls."""
+    return date.fromordinal(_EPOCH_ORDINAL + int(time.time() + _TZ_OFFSET_SEC) // 86400)
 
 # Configure logging
 logging.basicConfig(
@@ -44,11 +69,19 @@ SUPABASE_SECRET_KEY = os.getenv('SUPABASE_SECRET_KEY', '')
 CLIPROXY_URL = os.getenv('CLIPROXY_URL', 'http://localhost:8317')
 CLIPROXY_MANAGEMENT_KEY = os.getenv('CLIPROXY_MANAGEMENT_KEY', '')
 COLLECTOR_INTERVAL = int(os.getenv('COLLECTOR_INTERVAL_SECONDS', '300'))
+# Upper bound for the idle backoff; set equal to COLLECTOR_INTERVAL_SECONDS to disable it
+COLLECTOR_MAX_INTERVAL = max(COLLECTOR_INTERVAL, int(os.getenv('COLLECTOR_MAX_INTERVAL_SECONDS', '3600')))
+# store_usage_snapshot payload contract this collector writes (see store_usage_snapshot_version())
+STORE_USAGE_SNAPSHOT_VERSION = 1
+# Consecutive idle ticks before the polling interval starts doubling
+IDLE_TICKS_BEFORE_BACKOFF = 3
+# Scheduled ticks skipped once the Supabase circuit breaker opens
+CIRCUIT_OPEN_TICKS = 2
 TRIGGER_PORT = int(os.getenv('COLLECTOR_TRIGGER_PORT', '5001'))
 
 
-# Default pricing (USD per 1M tokens) - Updated Dec 2024
-DEFAULT_PRICING = {
+# Default pricing (USD per 1M tokens) - Updated Dec 2024, read-only
+DEFAULT_PRICING = MappingProxyType({
     # ... (pricing data remains the same)
     'gpt-4o': {'input': 2.50, 'output': 10.00},
     'gpt-4o-mini': {'input': 0.15, 'output': 0.60},
@@ -83,13 +116,87 @@ DEFAULT_PRICING = {
     'gemini-1.5-pro': {'input': 1.25, 'output': 5.00},
     'gemini-1.5-flash': {'input': 0.075, 'output': 0.30},
     '_default': {'input': 0.15, 'output': 0.60},
-}
+})
 LLM_PRICES_URL = "https://www.llm-prices.com/current-v1.json"
+# Back-off after a failed pricing refresh
+PRICING_RETRY_SECONDS = 600
+
+# Shared read-only default for missing nested dicts
+_EMPTY: Dict[str, Any] = {}
+
+# find_pricing_for_model memo, reset whenever a different pricing table is passed in
+_price_match_source: Optional[Dict] = None
+_price_match_cache: Dict[str, tuple] = {}
+_price_patterns: list = []
 
 # --- Globals ---
 supabase: Optional[Client] = None
+
+# Shared keep-alive session for CLIProxy and llm-prices.com, reused across ticks.
+# No default Authorization header: the management key must never reach third-party hosts.
+HTTP = requests.Session()
+_http_adapter = KeepAliveHTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+HTTP.mount('http://', _http_adapter)
+HTTP.mount('https://', _http_adapter)
+# Pricing is best-effort and fetched on the usage sync path: fail fast instead of retrying
+HTTP.mount(LLM_PRICES_URL, KeepAliveHTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+atexit.register(HTTP.close)
+
+# Bounded pool for sync work; each sync kind runs at most once at a time
+SYNC_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='collector-sync')
+atexit.register(lambda: SYNC_EXECUTOR.shutdown(wait=False))
+usage_sync_lock = threading.Lock()
+credential_sync_lock = threading.Lock()
+
+
+def submit_exclusive(lock: threading.Lock, fn: Callable[[], Any]) -> Optional[Future]:
+    """Queue fn on SYNC_EXECUTOR unless a run guarded by the same lock is in progress."""
+    if not lock.acquire(blocking=False):
+        return None
+
+    def task():
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Sync task {getattr(fn, '__name__', fn)} failed: {e}", exc_info=True)
+        finally:
+            lock.release()
+
+    try:
+        return SYNC_EXECUTOR.submit(task)
+    except RuntimeError:
+        lock.release()
+        raise
+
+# Background scheduler (set in main) and adaptive polling state
+scheduler: Optional[BackgroundScheduler] = None
+idle_streak = 0
+poll_interval = COLLECTOR_INTERVAL
+
 remote_pricing_cache: Dict[str, Dict[str, float]] = {}
 remote_pricing_last_fetch: float = 0
+# Time of the last failed refresh; retries wait PRICING_RETRY_SECONDS while the cached table is served
+remote_pricing_last_failure: float = 0
+# Bumped whenever remote_pricing_cache is replaced; keys the merged pricing below
+remote_pricing_version: int = 0
+_merged_pricing: Optional[Dict[str, Dict[str, float]]] = None
+_merged_pricing_version: int = -1
+
+# Last snapshot written by this process and its model rows keyed by (model, endpoint).
+# The collector is the only writer, so these stay authoritative between ticks;
+# they are seeded from Supabase on startup and after a failed write.
+# Model rows are kept as flat (requests, tokens, cost, input_tokens, output_tokens) tuples.
+UsageKey = Tuple[str, str]
+UsageValues = Tuple[int, int, float, int, int]
+_ZERO_USAGE: UsageValues = (0, 0, 0.0, 0, 0)
+LAST_SNAPSHOT: Dict[str, Any] = {}
+LAST_MODEL_USAGE: Dict[UsageKey, UsageValues] = {}
+# Last daily_stats row written by this process (same single-writer assumption).
+# Re-read from Supabase on startup, on a new day and after a failed write.
+LAST_DAILY: Dict[str, Any] = {}
 
 # --- Flask App Setup ---
 flask_app = Flask(__name__)
@@ -106,8 +213,8 @@ def health_check():
 def trigger_sync_endpoint():
     """Endpoint to manually trigger the full data collection and sync process."""
     logger.info("Manual trigger received for full sync.")
-    sync_thread = threading.Thread(target=run_full_sync_once)
-    sync_thread.start()
+    if not submit_exclusive(usage_sync_lock, run_full_sync_once):
+        return jsonify({"message": "Full data collection is already running."}), 409
     return jsonify({"message": "Full data collection process triggered."}), 202
 
 @api_bp.route('/credential-stats/sync', methods=['POST'])
@@ -115,18 +222,30 @@ def trigger_credential_stats_sync():
     """Endpoint to manually trigger credential usage stats sync."""
     logger.info("Manual trigger received for credential stats sync.")
 
-    def credential_stats_task():
-        try:
-            stats = sync_credential_stats(CLIPROXY_URL, CLIPROXY_MANAGEMENT_KEY, supabase)
-            logger.info(f"Credential stats sync completed: {stats}")
-        except Exception as e:
-            logger.error(f"Credential stats sync failed: {e}", exc_info=True)
-
-    sync_thread = threading.Thread(target=credential_stats_task)
-    sync_thread.start()
+    if not submit_exclusive(credential_sync_lock, run_credential_sync_once):
+        return jsonify({"message": "Credential stats sync is already running."}), 409
     return jsonify({"message": "Credential stats sync triggered."}), 202
 
 # --- Sync Functions ---
+def run_credential_sync_once():
+    """Helper function to run a single credential usage stats sync."""
+    stats = sync_credential_stats(CLIPROXY_URL, CLIPROXY_MANAGEMENT_KEY, supabase)
+    logger.info(f"Credential stats sync completed: {stats}")
+
+def combined_sync():
+    """Scheduled tick: run usage collection and credential stats sync side by side."""
+    if SUPABASE_BREAKER.is_open:
+        logger.warning("Skipping scheduled sync: Supabase circuit breaker is open.")
+        return
+    futures = []
+    for lock, fn in ((usage_sync_lock, run_full_sync_once), (credential_sync_lock, run_credential_sync_once)):
+        future = submit_exclusive(lock, fn)
+        if future is None:
+            logger.info(f"Skipping scheduled {fn.__name__}: a run is already in progress.")
+        else:
+            futures.append(future)
+    wait(futures)
+
 def run_full_sync_once():
     """Helper function to run a single full sync process (data collection)."""
     logger.info("Fetching usage data...")
@@ -135,19 +254,40 @@ def run_full_sync_once():
         store_usage_data(data)
     else:
         logger.warning("No data received from CLIProxy.")
+    adjust_poll_interval()
+
+def adjust_poll_interval():
+    """Back off the scheduled sync while CLIProxy is idle; return to the base interval on new usage."""
+    global poll_interval
+    backoff = idle_streak - IDLE_TICKS_BEFORE_BACKOFF + 1
+    interval = COLLECTOR_INTERVAL if backoff <= 0 else min(COLLECTOR_INTERVAL << backoff, COLLECTOR_MAX_INTERVAL)
+    if interval == poll_interval or scheduler is None:
+        return
+    scheduler.reschedule_job('collector_sync', trigger='interval', seconds=interval)
+    logger.info(f"Sync interval changed from {poll_interval}s to {interval}s (idle ticks: {idle_streak}).")
+    poll_interval = interval
+    set_circuit_window(interval)
+
+def set_circuit_window(interval: int):
+    """Keep the Supabase circuit breaker open across CIRCUIT_OPEN_TICKS ticks of the given interval."""
+    # The extra half tick covers the time between a tick starting and the breaker tripping
+    SUPABASE_BREAKER.reset_timeout = (CIRCUIT_OPEN_TICKS + 0.5) * interval
 
 # --- Core Logic Functions (fetch_remote_pricing, init_supabase, etc.) ---
 # These functions remain largely the same as before.
 def fetch_remote_pricing() -> Dict[str, Dict[str, float]]:
     # (Implementation from before)
-    global remote_pricing_cache, remote_pricing_last_fetch
-    if remote_pricing_cache and (time.time() - remote_pricing_last_fetch) < 3600:
+    global remote_pricing_cache, remote_pricing_last_fetch, remote_pricing_last_failure, remote_pricing_version
+    now = time.time()
+    if remote_pricing_cache and (now - remote_pricing_last_fetch) < 3600:
+        return remote_pricing_cache
+    if now - remote_pricing_last_failure < PRICING_RETRY_SECONDS:
         return remote_pricing_cache
     try:
         logger.info("Fetching latest pricing from llm-prices.com...")
-        response = requests.get(LLM_PRICES_URL, timeout=30)
+        response = HTTP.get(LLM_PRICES_URL, timeout=30)
         response.raise_for_status()
-        data = response.json()
+        data = _json_loads(response.content)
         pricing = {
             item['id'].lower(): {
                 'input': float(item['input']),
@@ -160,128 +300,276 @@ def fetch_remote_pricing() -> Dict[str, Dict[str, float]]:
         if pricing:
             remote_pricing_cache = pricing
             remote_pricing_last_fetch = time.time()
+            remote_pricing_version += 1
             return pricing
     except Exception as e:
         logger.warning(f"Could not fetch remote pricing: {e}")
-    return {}
+    remote_pricing_last_failure = time.time()
+    # Keep using the last good table (if any) until a refresh succeeds
+    return remote_pricing_cache
 
 def init_supabase() -> Client:
     if not SUPABASE_URL or not SUPABASE_SECRET_KEY:
         raise ValueError("SUPABASE_URL and SUPABASE_SECRET_KEY must be set")
-    return create_client(SUPABASE_URL, SUPABASE_SECRET_KEY)
+    # httpx drops idle connections after 5s by default, so every tick would pay a
+    # fresh TLS handshake; keep them across the (possibly backed-off) poll interval
+    # The response hook exposes HTTP status and Retry-After to execute_with_retry
+    http_client = keepalive_httpx_client(timeout=60, keepalive_expiry=COLLECTOR_MAX_INTERVAL + 60,
+                                         event_hooks={'response': [record_response]})
+    try:
+        options = ClientOptions(httpx_client=http_client)
+    except TypeError:
+        # supabase-py release without httpx_client support: use its default pool
+        http_client.close()
+        return create_client(SUPABASE_URL, SUPABASE_SECRET_KEY)
+    atexit.register(http_client.close)
+    return create_client(SUPABASE_URL, SUPABASE_SECRET_KEY, options=options)
+
+def check_schema_version():
+    """Fail fast when the database does not have the store_usage_snapshot this collector writes through."""
+    # An older function would silently ignore parts of the payload (e.g. the daily_stats row)
+    try:
+        version = execute_with_retry(supabase.rpc('store_usage_snapshot_version', {})).data
+    except Exception as e:
+        raise RuntimeError(
+            "store_usage_snapshot_version() not found; apply migrations/005_add_store_usage_snapshot_rpc.sql"
+        ) from e
+    if version != STORE_USAGE_SNAPSHOT_VERSION:
+        raise RuntimeError(
+            f"Database has store_usage_snapshot version {version}, collector requires "
+            f"{STORE_USAGE_SNAPSHOT_VERSION}; apply migrations/005_add_store_usage_snapshot_rpc.sql"
+        )
 
 def fetch_usage_data() -> Optional[Dict[str, Any]]:
     # (Implementation from before)
     url = f"{CLIPROXY_URL}/v0/management/usage"
     headers = {'Authorization': f'Bearer {CLIPROXY_MANAGEMENT_KEY}'} if CLIPROXY_MANAGEMENT_KEY else {}
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = HTTP.get(url, headers=headers, timeout=30)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        return _json_loads(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
         logger.error(f"Failed to fetch usage data: {e}")
         return None
 
 def get_model_pricing() -> Dict[str, Dict[str, float]]:
     # (Implementation from before)
+    global _merged_pricing, _merged_pricing_version
     remote_pricing = fetch_remote_pricing()
-    if remote_pricing:
-        return {**DEFAULT_PRICING, **remote_pricing}
-    return DEFAULT_PRICING
+    if not remote_pricing:
+        return DEFAULT_PRICING
+    if _merged_pricing is None or _merged_pricing_version != remote_pricing_version:
+        _merged_pricing = {**DEFAULT_PRICING, **remote_pricing}
+        _merged_pricing_version = remote_pricing_version
+    return _merged_pricing
 
 def find_pricing_for_model(model_name: str, pricing: Dict) -> tuple[Dict[str, float], bool]:
-    # (Implementation from before)
+    """Resolve pricing for a model name, memoized per pricing table."""
+    global _price_match_source, _price_patterns
+    if pricing is not _price_match_source:
+        _price_match_source = pricing
+        _price_match_cache.clear()
+        # Longest pattern first so the most specific substring match wins
+        _price_patterns = sorted((p for p in pricing if p != '_default'), key=len, reverse=True)
+
     model_lower = model_name.lower()
+    match = _price_match_cache.get(model_lower)
+    if match is None:
+        match = _price_match_cache[model_lower] = _match_pricing(model_lower, pricing)
+    return match
+
+def _match_pricing(model_lower: str, pricing: Dict) -> tuple[Dict[str, float], bool]:
     if model_lower in pricing:
         return pricing[model_lower], True
-    for pattern, prices in pricing.items():
-        if pattern != '_default' and (pattern in model_lower or model_lower in pattern):
-            return prices, True
+    for pattern in _price_patterns:
+        if pattern in model_lower:
+            return pricing[pattern], True
+    for pattern in _price_patterns:
+        if model_lower in pattern:
+            return pricing[pattern], True
     return pricing.get('_default', {'input': 0.15, 'output': 0.60}), False
 
 def calculate_cost(input_tokens: int, output_tokens: int, pricing: Dict[str, float]) -> float:
     # (Implementation from before)
     return ((input_tokens / 1_000_000) * pricing['input']) + ((output_tokens / 1_000_000) * pricing['output'])
 
+def usage_key(record: Dict[str, Any]) -> UsageKey:
+    """Breakdown key for a model_usage record."""
+    # Key must handle potential None for api_endpoint (though unlikely if schema enforces)
+    return record.get('model_name'), record.get('api_endpoint') or 'unknown'
+
+def usage_values(record: Dict[str, Any]) -> UsageValues:
+    """Counters of a model_usage record in UsageValues order."""
+    return (
+        record.get('request_count', 0),
+        record.get('total_tokens', 0),
+        float(record.get('estimated_cost_usd', 0)),
+        record.get('input_tokens', 0),
+        record.get('output_tokens', 0),
+    )
+
+def load_previous_snapshot():
+    """Seed LAST_SNAPSHOT / LAST_MODEL_USAGE from the latest stored snapshot."""
+    global LAST_SNAPSHOT, LAST_MODEL_USAGE
+    snap_resp = execute_with_retry(
+        supabase.table('usage_snapshots')
+        .select('id, total_requests, success_count, failure_count, total_tokens, cumulative_cost_usd')
+        .order('collected_at', desc=True)
+        .limit(1)
+    )
+    if not snap_resp.data:
+        LAST_SNAPSHOT, LAST_MODEL_USAGE = {}, {}
+        return
+    usage_resp = execute_with_retry(
+        supabase.table('model_usage')
+        .select('model_name, api_endpoint, request_count, total_tokens, estimated_cost_usd, input_tokens, output_tokens')
+        .eq('snapshot_id', snap_resp.data[0]['id'])
+    )
+    LAST_SNAPSHOT = snap_resp.data[0]
+    LAST_MODEL_USAGE = {usage_key(r): usage_values(r) for r in usage_resp.data}
+
+def build_daily_stats(today_iso: str, breakdown_deltas: Dict[str, Dict], inc_requests: int, inc_success: int,
+                      inc_failure: int, inc_tokens: int, inc_cost: float) -> Dict[str, Any]:
+    """Today's daily_stats row with this tick's increments merged in.
+
+    Merges into a copy of the cached LAST_DAILY row; the caller replaces the cache
+    only once the row has been written.
+    """
+    # Existing daily_stats row for today
+    if LAST_DAILY.get('stat_date') == today_iso:
+        existing_daily = {**LAST_DAILY, 'breakdown': copy.deepcopy(LAST_DAILY.get('breakdown'))}
+    else:
+        daily_stats_resp = execute_with_retry(supabase.table('daily_stats').select('*').eq('stat_date', today_iso))
+        existing_daily = daily_stats_resp.data[0] if daily_stats_resp.data else {
+            'total_requests': 0, 'success_count': 0, 'failure_count': 0, 'total_tokens': 0, 'estimated_cost_usd': 0,
+            'breakdown': {'models': {}, 'endpoints': {}}
+        }
+
+    # Merge breakdown deltas into existing breakdown
+    existing_breakdown = existing_daily.get('breakdown') or {'models': {}, 'endpoints': {}}
+    # Ensure structure
+    existing_models = existing_breakdown.setdefault('models', {})
+    existing_endpoints = existing_breakdown.setdefault('endpoints', {})
+
+    # Merge Models
+    for m, data in breakdown_deltas['models'].items():
+        existing = existing_models.setdefault(m, {'requests': 0, 'tokens': 0, 'cost': 0.0, 'input_tokens': 0, 'output_tokens': 0})
+        existing['requests'] += data['requests']
+        existing['tokens'] += data['tokens']
+        existing['cost'] += data['cost']
+        # Rows written before token split tracking have no input/output keys
+        existing['input_tokens'] = existing.get('input_tokens', 0) + data['input_tokens']
+        existing['output_tokens'] = existing.get('output_tokens', 0) + data['output_tokens']
+
+    # Merge Endpoints
+    for e, data in breakdown_deltas['endpoints'].items():
+        existing = existing_endpoints.setdefault(e, {'requests': 0, 'tokens': 0, 'cost': 0.0, 'models': {}})
+        existing['requests'] += data['requests']
+        existing['tokens'] += data['tokens']
+        existing['cost'] += data['cost']
+
+        # Merge nested models
+        existing_nested = existing.setdefault('models', {})
+        for mName, mData in data['models'].items():
+            m_data = existing_nested.setdefault(mName, {'requests': 0, 'tokens': 0, 'cost': 0.0})
+            m_data['requests'] += mData['requests']
+            m_data['tokens'] += mData['tokens']
+            m_data['cost'] += mData['cost']
+
+
+    # --- Self-Healing: Recalculate Totals from Merged Breakdown ---
+    # This ensures that the global totals ALWAYS match the sum of the breakdown models.
+    # It fixes inconsistencies caused by race conditions or partial updates.
+    total_cost_from_breakdown = sum(m['cost'] for m in existing_breakdown['models'].values())
+    total_tokens_from_breakdown = sum(m['tokens'] for m in existing_breakdown['models'].values())
+    total_requests_from_breakdown = sum(m['requests'] for m in existing_breakdown['models'].values())
+
+    # Add incremental delta to existing daily stats
+    # We prefer the recalculated totals from breakdown, but we fall back to incremental if breakdown is empty
+    # (though breakdown shouldn't be empty if we have usage)
+
+    final_cost = total_cost_from_breakdown if total_cost_from_breakdown > 0 else (float(existing_daily.get('estimated_cost_usd', 0)) + inc_cost)
+    final_tokens = total_tokens_from_breakdown if total_tokens_from_breakdown > 0 else (existing_daily.get('total_tokens', 0) + inc_tokens)
+
+    # For requests, we might have successful requests that aren't in model breakdown?
+    # No, all requests go through models.
+    final_requests = total_requests_from_breakdown if total_requests_from_breakdown > 0 else (existing_daily.get('total_requests', 0) + inc_requests)
+
+    daily_data = {
+        'stat_date': today_iso,
+        'total_requests': final_requests,
+        'success_count': existing_daily.get('success_count', 0) + inc_success,
+        'failure_count': existing_daily.get('failure_count', 0) + inc_failure,
+        'total_tokens': final_tokens,
+        'estimated_cost_usd': final_cost,
+        'breakdown': existing_breakdown # Save the updated breakdown
+    }
+    return daily_data
+
 def store_usage_data(data: Dict[str, Any]) -> bool:
     """Store usage data in Supabase database with proper daily delta calculation."""
+    global LAST_SNAPSHOT, LAST_MODEL_USAGE, LAST_DAILY, idle_streak
     if not supabase or not data or 'usage' not in data:
         return False
     usage = data['usage']
     pricing = get_model_pricing()
-    
+    cache_current = False
+
     try:
+        if not LAST_SNAPSHOT:
+            load_previous_snapshot()
+        # The snapshot stored just before this one (None on an empty database)
+        prev_snap = LAST_SNAPSHOT or None
+        prev_usage_map = LAST_MODEL_USAGE
+
         # Current cumulative values from CLIProxy
         current_requests = usage.get('total_requests', 0)
         current_success = usage.get('success_count', 0)
         current_failure = usage.get('failure_count', 0)
         current_tokens = usage.get('total_tokens', 0)
         
-        # Insert snapshot with cumulative data
-        snapshot_data = {
-            'raw_data': data,
-            'total_requests': current_requests,
-            'success_count': current_success,
-            'failure_count': current_failure,
-            'total_tokens': current_tokens
-        }
-        # Track cumulative cost (sum of costs from all snapshots so far)
-        last_cost_resp = supabase.table('usage_snapshots') \
-            .select('cumulative_cost_usd') \
-            .order('collected_at', desc=True) \
-            .limit(1) \
-            .execute()
-        last_cost_total = last_cost_resp.data[0].get('cumulative_cost_usd', 0) if last_cost_resp.data else 0
-        snapshot_data['cumulative_cost_usd'] = last_cost_total  # placeholder, updated after cost calc
-
-        snapshot_result = supabase.table('usage_snapshots').insert(snapshot_data).execute()
-        snapshot_id = snapshot_result.data[0]['id']
-        
         # Process model-level data
         model_records = []
+        curr_usage_map: Dict[UsageKey, UsageValues] = {}
         total_cost = 0
         for api_endpoint, api_data in usage.get('apis', {}).items():
             for model_name, model_data in api_data.get('models', {}).items():
-                input_tok = sum(d.get('tokens', {}).get('input_tokens', 0) for d in model_data.get('details', []))
-                output_tok = sum(d.get('tokens', {}).get('output_tokens', 0) for d in model_data.get('details', []))
+                input_tok = output_tok = 0
+                for d in model_data.get('details', ()):
+                    tok = d.get('tokens') or _EMPTY
+                    input_tok += tok.get('input_tokens', 0)
+                    output_tok += tok.get('output_tokens', 0)
                 model_price, _ = find_pricing_for_model(model_name, pricing)
                 cost = calculate_cost(input_tok, output_tok, model_price)
                 total_cost += cost
+                # Same scale as the DECIMAL(10, 6) column, so the cached values below
+                # are identical to what the next tick would read back
+                cost = round(cost, 6)
+                request_count = model_data.get('total_requests', 0)
+                total_tokens = model_data.get('total_tokens', 0)
                 model_records.append({
-                    'snapshot_id': snapshot_id,
                     'model_name': model_name,
                     'estimated_cost_usd': cost,
-                    'request_count': model_data.get('total_requests', 0),
+                    'request_count': request_count,
                     'input_tokens': input_tok,
                     'output_tokens': output_tok,
-                    'total_tokens': model_data.get('total_tokens', 0),
+                    'total_tokens': total_tokens,
                     'api_endpoint': api_endpoint
                 })
-        
-        if model_records:
-            supabase.table('model_usage').insert(model_records).execute()
+                curr_usage_map[model_name, api_endpoint or 'unknown'] = (
+                    request_count, total_tokens, cost, input_tok, output_tok
+                )
 
-        # Update snapshot cumulative cost
-        cumulative_cost = last_cost_total + total_cost
-        supabase.table('usage_snapshots').update({'cumulative_cost_usd': cumulative_cost}).eq('id', snapshot_id).execute()
+        # Cumulative cost continues from the cached previous snapshot
+        prev_cumulative_cost = float((prev_snap or _EMPTY).get('cumulative_cost_usd') or 0)
+        cumulative_cost = round(prev_cumulative_cost + total_cost, 6)
 
         # === Calculate daily delta stats (Incremental Approach) ===
         # Robust against restarts: Calculate delta since LAST snapshot and add to daily_stats
-        today = datetime.now(APP_TIMEZONE).date()
+        today = local_today()
         today_iso = today.isoformat()
 
-        # 1. Get the previous snapshot (just before the one we just inserted)
-        # We inserted the new one, so we want the one with collected_at < current collected_at
-        # Or simpler: get the 2nd latest snapshot (since we just inserted the latest)
-        prev_snap_resp = supabase.table('usage_snapshots') \
-            .select('id, total_requests, success_count, failure_count, total_tokens, cumulative_cost_usd') \
-            .order('collected_at', desc=True) \
-            .limit(2) \
-            .execute()
-
-        has_prev = len(prev_snap_resp.data) >= 2
-        prev_snap = prev_snap_resp.data[1] if has_prev else None
-
+        # Global delta against the previous snapshot
         if prev_snap:
             # Calculate incremental delta
             inc_requests = current_requests - prev_snap.get('total_requests', 0)
@@ -313,51 +601,23 @@ def store_usage_data(data: Dict[str, Any]) -> bool:
             inc_tokens = current_tokens
             inc_cost = total_cost
 
-        # 2. Get existing daily_stats for today
-        daily_stats_resp = supabase.table('daily_stats').select('*').eq('stat_date', today_iso).execute()
-        existing_daily = daily_stats_resp.data[0] if daily_stats_resp.data else {
-            'total_requests': 0, 'success_count': 0, 'failure_count': 0, 'total_tokens': 0, 'estimated_cost_usd': 0,
-            'breakdown': {'models': {}, 'endpoints': {}}
-        }
-
         # Initialize breakdown deltas
         breakdown_deltas = {'models': {}, 'endpoints': {}}
 
         if prev_snap:
             # ... (global delta calculation kept as is) ...
             # Calculate granular deltas for breakdown
-            prev_usage_resp = supabase.table('model_usage').select('*').eq('snapshot_id', prev_snap['id']).execute()
-            prev_usage_map = {}
-            for r in prev_usage_resp.data:
-                # Key must handle potential None for api_endpoint (though unlikely if schema enforces)
-                ep = r.get('api_endpoint') or 'unknown'
-                key = f"{r.get('model_name')}|{ep}"
-                prev_usage_map[key] = r
-
-            curr_usage_map = {}
-            for r in model_records:
-                ep = r.get('api_endpoint') or 'unknown'
-                key = f"{r.get('model_name')}|{ep}"
-                curr_usage_map[key] = r
-
-            all_keys = set(prev_usage_map.keys()) | set(curr_usage_map.keys())
+            all_keys = prev_usage_map.keys() | curr_usage_map.keys()
 
             for key in all_keys:
-                prev = prev_usage_map.get(key, {})
-                curr = curr_usage_map.get(key, {})
-
-                # Get values safely
-                p_req = prev.get('request_count', 0)
-                p_tok = prev.get('total_tokens', 0)
-                p_cost = float(prev.get('estimated_cost_usd', 0))
-                p_in = prev.get('input_tokens', 0)
-                p_out = prev.get('output_tokens', 0)
-
-                c_req = curr.get('request_count', 0)
-                c_tok = curr.get('total_tokens', 0)
-                c_cost = float(curr.get('estimated_cost_usd', 0))
-                c_in = curr.get('input_tokens', 0)
-                c_out = curr.get('output_tokens', 0)
+                prev = prev_usage_map.get(key, _ZERO_USAGE)
+                curr = curr_usage_map.get(key, _ZERO_USAGE)
+                if prev == curr:
+                    # Unchanged since the last tick (the common case): every delta is zero
+                    continue
+                model_name, endpoint = key
+                p_req, p_tok, p_cost, p_in, p_out = prev
+                c_req, c_tok, c_cost, c_in, c_out = curr
 
                 d_req = c_req - p_req
                 d_tok = c_tok - p_tok
@@ -378,7 +638,7 @@ def store_usage_data(data: Dict[str, Any]) -> bool:
                 if d_cost > 10:
                     # If delta is roughly equal to Current (Cumulative), it's a False Start.
                     if abs(d_cost - c_cost) < 0.1:
-                        logger.warning(f"Skipping False Start: ${d_cost:.2f} for key {key} (Snap {snapshot_id}). Removing from global stats.")
+                        logger.warning(f"Skipping False Start: ${d_cost:.2f} for key {model_name}|{endpoint}. Removing from global stats.")
                         # Adjust global increments to remove this false start
                         inc_requests -= d_req
                         inc_tokens -= d_tok
@@ -389,36 +649,27 @@ def store_usage_data(data: Dict[str, Any]) -> bool:
                         # This might lead to Success+Failure > TotalRequests for this day,
                         # but that is better than a massive cost spike.
 
-                        # We must update prev_usage_map so next delta is correct (small)
-                        # But since we are constructing breakdown_deltas locally and NOT updating a persistent state object
-                        # (prev_usage_map is rebuilt from DB next time), we just need to NOT add to breakdown_deltas.
+                        # The next tick diffs against this snapshot's cumulative values
+                        # (LAST_MODEL_USAGE), so we just need to NOT add to breakdown_deltas.
                         continue
 
                 if d_req > 0 or d_cost > 0:
-                    parts = key.split('|')
-                    model_name = parts[0]
-                    endpoint = parts[1]
-
                     # Add to Models
-                    if model_name not in breakdown_deltas['models']:
-                        breakdown_deltas['models'][model_name] = {'requests': 0, 'tokens': 0, 'cost': 0.0, 'input_tokens': 0, 'output_tokens': 0}
-                    breakdown_deltas['models'][model_name]['requests'] += d_req
-                    breakdown_deltas['models'][model_name]['tokens'] += d_tok
-                    breakdown_deltas['models'][model_name]['cost'] += d_cost
-                    breakdown_deltas['models'][model_name]['input_tokens'] += d_in
-                    breakdown_deltas['models'][model_name]['output_tokens'] += d_out
+                    m_totals = breakdown_deltas['models'].setdefault(model_name, {'requests': 0, 'tokens': 0, 'cost': 0.0, 'input_tokens': 0, 'output_tokens': 0})
+                    m_totals['requests'] += d_req
+                    m_totals['tokens'] += d_tok
+                    m_totals['cost'] += d_cost
+                    m_totals['input_tokens'] += d_in
+                    m_totals['output_tokens'] += d_out
 
                     # Add to Endpoints
-                    if endpoint not in breakdown_deltas['endpoints']:
-                        breakdown_deltas['endpoints'][endpoint] = {'requests': 0, 'tokens': 0, 'cost': 0.0, 'models': {}}
-                    breakdown_deltas['endpoints'][endpoint]['requests'] += d_req
-                    breakdown_deltas['endpoints'][endpoint]['tokens'] += d_tok
-                    breakdown_deltas['endpoints'][endpoint]['cost'] += d_cost
+                    e_totals = breakdown_deltas['endpoints'].setdefault(endpoint, {'requests': 0, 'tokens': 0, 'cost': 0.0, 'models': {}})
+                    e_totals['requests'] += d_req
+                    e_totals['tokens'] += d_tok
+                    e_totals['cost'] += d_cost
 
                     # Add to nested models within endpoint
-                    if model_name not in breakdown_deltas['endpoints'][endpoint]['models']:
-                         breakdown_deltas['endpoints'][endpoint]['models'][model_name] = {'requests': 0, 'tokens': 0, 'cost': 0.0}
-                    m_data = breakdown_deltas['endpoints'][endpoint]['models'][model_name]
+                    m_data = e_totals['models'].setdefault(model_name, {'requests': 0, 'tokens': 0, 'cost': 0.0})
                     m_data['requests'] += d_req
                     m_data['tokens'] += d_tok
                     m_data['cost'] += d_cost
@@ -426,33 +677,22 @@ def store_usage_data(data: Dict[str, Any]) -> bool:
 
         else:
             # First snapshot ever - treat current as delta
-            for r in model_records:
-                model_name = r.get('model_name')
-                endpoint = r.get('api_endpoint') or 'unknown'
-                req = r.get('request_count', 0)
-                tok = r.get('total_tokens', 0)
-                cost = float(r.get('estimated_cost_usd', 0))
-                in_tok = r.get('input_tokens', 0)
-                out_tok = r.get('output_tokens', 0)
-
-                if model_name not in breakdown_deltas['models']:
-                    breakdown_deltas['models'][model_name] = {'requests': 0, 'tokens': 0, 'cost': 0.0, 'input_tokens': 0, 'output_tokens': 0}
-                breakdown_deltas['models'][model_name]['requests'] += req
-                breakdown_deltas['models'][model_name]['tokens'] += tok
-                breakdown_deltas['models'][model_name]['cost'] += cost
-                breakdown_deltas['models'][model_name]['input_tokens'] += in_tok
-                breakdown_deltas['models'][model_name]['output_tokens'] += out_tok
-
-                if endpoint not in breakdown_deltas['endpoints']:
-                    breakdown_deltas['endpoints'][endpoint] = {'requests': 0, 'tokens': 0, 'cost': 0.0, 'models': {}}
-                breakdown_deltas['endpoints'][endpoint]['requests'] += req
-                breakdown_deltas['endpoints'][endpoint]['tokens'] += tok
-                breakdown_deltas['endpoints'][endpoint]['cost'] += cost
+            for (model_name, endpoint), (req, tok, cost, in_tok, out_tok) in curr_usage_map.items():
+
+                m_totals = breakdown_deltas['models'].setdefault(model_name, {'requests': 0, 'tokens': 0, 'cost': 0.0, 'input_tokens': 0, 'output_tokens': 0})
+                m_totals['requests'] += req
+                m_totals['tokens'] += tok
+                m_totals['cost'] += cost
+                m_totals['input_tokens'] += in_tok
+                m_totals['output_tokens'] += out_tok
+
+                e_totals = breakdown_deltas['endpoints'].setdefault(endpoint, {'requests': 0, 'tokens': 0, 'cost': 0.0, 'models': {}})
+                e_totals['requests'] += req
+                e_totals['tokens'] += tok
+                e_totals['cost'] += cost
 
                 # Add to nested models within endpoint
-                if model_name not in breakdown_deltas['endpoints'][endpoint]['models']:
-                        breakdown_deltas['endpoints'][endpoint]['models'][model_name] = {'requests': 0, 'tokens': 0, 'cost': 0.0}
-                m_data = breakdown_deltas['endpoints'][endpoint]['models'][model_name]
+                m_data = e_totals['models'].setdefault(model_name, {'requests': 0, 'tokens': 0, 'cost': 0.0})
                 m_data['requests'] += req
                 m_data['tokens'] += tok
                 m_data['cost'] += cost
@@ -483,87 +723,74 @@ def store_usage_data(data: Dict[str, Any]) -> bool:
             inc_tokens = safe_inc_tokens
             inc_requests = safe_inc_requests
 
-        # Merge breakdown deltas into existing breakdown
-        existing_breakdown = existing_daily.get('breakdown') or {'models': {}, 'endpoints': {}}
-        # Ensure structure
-        if 'models' not in existing_breakdown: existing_breakdown['models'] = {}
-        if 'endpoints' not in existing_breakdown: existing_breakdown['endpoints'] = {}
-
-        # Merge Models
-        for m, data in breakdown_deltas['models'].items():
-            if m not in existing_breakdown['models']:
-                existing_breakdown['models'][m] = {'requests': 0, 'tokens': 0, 'cost': 0.0, 'input_tokens': 0, 'output_tokens': 0}
-            existing = existing_breakdown['models'][m]
-            existing['requests'] += data['requests']
-            existing['tokens'] += data['tokens']
-            existing['cost'] += data['cost']
-            existing['input_tokens'] = existing.get('input_tokens', 0) + data.get('input_tokens', 0)
-            existing['output_tokens'] = existing.get('output_tokens', 0) + data.get('output_tokens', 0)
-
-        # Merge Endpoints
-        for e, data in breakdown_deltas['endpoints'].items():
-            if e not in existing_breakdown['endpoints']:
-                existing_breakdown['endpoints'][e] = {'requests': 0, 'tokens': 0, 'cost': 0.0, 'models': {}}
-            existing = existing_breakdown['endpoints'][e]
-            existing['requests'] += data['requests']
-            existing['tokens'] += data['tokens']
-            existing['cost'] += data['cost']
-
-            # Merge nested models
-            if 'models' not in existing: existing['models'] = {}
-            for mName, mData in data.get('models', {}).items():
-                 if mName not in existing['models']:
-                      existing['models'][mName] = {'requests': 0, 'tokens': 0, 'cost': 0.0}
-                 existing['models'][mName]['requests'] += mData['requests']
-                 existing['models'][mName]['tokens'] += mData['tokens']
-                 existing['models'][mName]['cost'] += mData['cost']
-
-
-        # --- Self-Healing: Recalculate Totals from Merged Breakdown ---
-        # This ensures that the global totals ALWAYS match the sum of the breakdown models.
-        # It fixes inconsistencies caused by race conditions or partial updates.
-        total_cost_from_breakdown = sum(m['cost'] for m in existing_breakdown['models'].values())
-        total_tokens_from_breakdown = sum(m['tokens'] for m in existing_breakdown['models'].values())
-        total_requests_from_breakdown = sum(m['requests'] for m in existing_breakdown['models'].values())
-
-        # 3. Add incremental delta to existing daily stats
-        # We prefer the recalculated totals from breakdown, but we fall back to incremental if breakdown is empty
-        # (though breakdown shouldn't be empty if we have usage)
-
-        final_cost = total_cost_from_breakdown if total_cost_from_breakdown > 0 else (float(existing_daily.get('estimated_cost_usd', 0)) + inc_cost)
-        final_tokens = total_tokens_from_breakdown if total_tokens_from_breakdown > 0 else (existing_daily.get('total_tokens', 0) + inc_tokens)
-
-        # For requests, we might have successful requests that aren't in model breakdown?
-        # No, all requests go through models.
-        final_requests = total_requests_from_breakdown if total_requests_from_breakdown > 0 else (existing_daily.get('total_requests', 0) + inc_requests)
-
-        daily_data = {
-            'stat_date': today_iso,
-            'total_requests': final_requests,
-            'success_count': existing_daily.get('success_count', 0) + inc_success,
-            'failure_count': existing_daily.get('failure_count', 0) + inc_failure,
-            'total_tokens': final_tokens,
-            'estimated_cost_usd': final_cost,
-            'breakdown': existing_breakdown # Save the updated breakdown
-        }
-
-        supabase.table('daily_stats').upsert(daily_data, on_conflict='stat_date').execute()
+        if inc_requests or inc_tokens or inc_cost or inc_success or inc_failure:
+            daily_data = build_daily_stats(today_iso, breakdown_deltas, inc_requests, inc_success,
+                                           inc_failure, inc_tokens, inc_cost)
+        else:
+            # Idle tick: today's row would be rewritten unchanged
+            daily_data = None
 
-        logger.info(f"Stored snapshot {snapshot_id}. Incremental: {inc_requests} req. Daily Total: {daily_data['total_requests']}")
+        # Insert snapshot + model rows, and upsert today's daily_stats row when it
+        # changed, in one round-trip (migrations/005).
+        # The raw payload is stored gzipped (raw_data_gz bytea), sent base64-encoded.
+        snapshot_data = {
+            'raw_data_gz': base64.b64encode(gzip.compress(_json_dumps(data), compresslevel=3)).decode('ascii'),
+            'total_requests': current_requests,
+            'success_count': current_success,
+            'failure_count': current_failure,
+            'total_tokens': current_tokens,
+            'cumulative_cost_usd': cumulative_cost,
+            'daily': daily_data,
+        }
+        # Not idempotent: only retried when the call provably did not run
+        stored = execute_with_retry(supabase.rpc('store_usage_snapshot', {
+            'p_snapshot': snapshot_data,
+            'p_models': model_records,
+        }), idempotent=False).data
+        snapshot_id = stored['snapshot_id']
+
+        # The rows just written are the baseline for the next tick; no read-back needed
+        LAST_SNAPSHOT = {
+            'id': snapshot_id,
+            'total_requests': current_requests,
+            'success_count': current_success,
+            'failure_count': current_failure,
+            'total_tokens': current_tokens,
+            'cumulative_cost_usd': cumulative_cost,
+        }
+        LAST_MODEL_USAGE = curr_usage_map
+        if daily_data is not None:
+            LAST_DAILY = daily_data
+        cache_current = True
+
+        if daily_data is None:
+            idle_streak += 1
+            logger.info(f"Stored snapshot {snapshot_id}. No usage delta; daily_stats unchanged.")
+        else:
+            idle_streak = 0
+            logger.info(f"Stored snapshot {snapshot_id}. Incremental: {inc_requests} req. Daily Total: {daily_data['total_requests']}")
         return True
+    except CircuitOpenError as e:
+        # Nothing was sent and the caches are only replaced after a write, so they are still accurate
+        logger.warning(f"Skipped storing usage data: {e}")
+        return False
     except Exception as e:
         logger.error(f"Failed to store usage data: {e}")
+        if not cache_current:
+            # Unknown whether the snapshot was written; re-read the baseline next tick
+            LAST_SNAPSHOT, LAST_MODEL_USAGE, LAST_DAILY = {}, {}, {}
         return False
 
 # --- Main Application ---
 def main():
     """Main collector startup."""
-    global supabase
+    global supabase, scheduler
     logger.info("Starting CLIProxy Usage Collector")
 
     # Initialize Supabase
     try:
         supabase = init_supabase()
+        check_schema_version()
         logger.info("Supabase client initialized.")
     except Exception as e:
         logger.critical(f"CRITICAL: Failed to initialize Supabase: {e}", exc_info=True)
@@ -574,22 +801,21 @@ def main():
 
     # Start the background scheduler
     scheduler = BackgroundScheduler(daemon=True)
+    set_circuit_window(COLLECTOR_INTERVAL)
 
-    # Schedule usage data collection (every COLLECTOR_INTERVAL seconds)
-    scheduler.add_job(run_full_sync_once, 'interval', seconds=COLLECTOR_INTERVAL)
-
-    # Schedule credential usage stats sync (runs with usage collection)
+    # Schedule usage data collection and credential usage stats sync together
+    # (every COLLECTOR_INTERVAL seconds); both run concurrently on SYNC_EXECUTOR
     scheduler.add_job(
-        lambda: sync_credential_stats(CLIPROXY_URL, CLIPROXY_MANAGEMENT_KEY, supabase),
+        combined_sync,
         'interval',
         seconds=COLLECTOR_INTERVAL,
-        id='credential_stats_sync',
+        id='collector_sync',
         next_run_time=datetime.now() + timedelta(seconds=10)  # Run 10s after startup
     )
 
     scheduler.start()
-    logger.info(f"Background sync scheduled every {COLLECTOR_INTERVAL} seconds.")
-    logger.info(f"Credential stats sync scheduled every {COLLECTOR_INTERVAL} seconds.")
+    logger.info(f"Usage and credential stats sync scheduled every {COLLECTOR_INTERVAL} seconds "
+                f"(backing off to {COLLECTOR_MAX_INTERVAL} seconds while idle).")
 
     # Start the Flask app using Waitress
     logger.info(f"Flask server starting on http://0.0.0.0:{TRIGGER_PORT}")
@@ -0,0 +1,121 @@
+-- ============================================
+-- Migration: store_usage_snapshot RPC
+-- ============================================
+-- Collapses the collector's per-tick write path into a single round-trip.
+-- Previously each tick issued: select last cumulative cost, insert snapshot,
+-- insert model_usage rows, update cumulative cost, select/insert/update
+-- today's daily_stats row. The collector now computes the cumulative cost and
+-- the daily row itself (restart and false-start handling, breakdown merge)
+-- and this function writes the snapshot, its model rows and the daily row in
+-- one transaction.
+--
+-- Required by collector/main.py (store_usage_data). Run in Supabase SQL Editor.
+--
+-- Date: 2026-10-15
+-- ============================================
+
+-- Older installs created usage_snapshots without this column
+ALTER TABLE usage_snapshots ADD COLUMN IF NOT EXISTS cumulative_cost_usd DECIMAL(10, 6) DEFAULT 0;
+-- Gzipped CLIProxy payload; replaces raw_data for new snapshots
+ALTER TABLE usage_snapshots ADD COLUMN IF NOT EXISTS raw_data_gz BYTEA;
+-- Per-model / per-endpoint daily breakdown written by the collector
+ALTER TABLE daily_stats ADD COLUMN IF NOT EXISTS breakdown JSONB DEFAULT '{}'::jsonb;
+
+-- p_snapshot: { raw_data_gz, total_requests, success_count, failure_count, total_tokens,
+--               cumulative_cost_usd, daily }
+--             raw_data_gz is the gzipped CLIProxy payload JSON, base64-encoded
+--             cumulative_cost_usd is computed by the collector from its previous snapshot
+--             daily is today's full daily_stats row { stat_date, total_requests, success_count,
+--             failure_count, total_tokens, estimated_cost_usd, breakdown }, upserted on
+--             stat_date; null or absent on ticks without new usage
+-- p_models:   [ { api_endpoint, model_name, request_count, input_tokens,
+--                 output_tokens, total_tokens, estimated_cost_usd }, ... ]
+--
+-- Returns: { snapshot_id, cumulative_cost_usd }
+CREATE OR REPLACE FUNCTION store_usage_snapshot(p_snapshot JSONB, p_models JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_snapshot_id BIGINT;
+    v_cumulative DECIMAL(10, 6);
+BEGIN
+    v_cumulative := (p_snapshot->>'cumulative_cost_usd')::DECIMAL;
+    IF v_cumulative IS NULL THEN
+        RAISE EXCEPTION 'store_usage_snapshot: p_snapshot.cumulative_cost_usd is required';
+    END IF;
+
+    INSERT INTO usage_snapshots (
+        raw_data_gz, total_requests, success_count, failure_count, total_tokens, cumulative_cost_usd
+    ) VALUES (
+        decode(p_snapshot->>'raw_data_gz', 'base64'),
+        COALESCE((p_snapshot->>'total_requests')::INTEGER, 0),
+        COALESCE((p_snapshot->>'success_count')::INTEGER, 0),
+        COALESCE((p_snapshot->>'failure_count')::INTEGER, 0),
+        COALESCE((p_snapshot->>'total_tokens')::BIGINT, 0),
+        v_cumulative
+    )
+    RETURNING id INTO v_snapshot_id;
+
+    INSERT INTO model_usage (
+        snapshot_id, api_endpoint, model_name, request_count,
+        input_tokens, output_tokens, total_tokens, estimated_cost_usd
+    )
+    SELECT v_snapshot_id, m.api_endpoint, m.model_name, m.request_count,
+           m.input_tokens, m.output_tokens, m.total_tokens, m.estimated_cost_usd
+    FROM jsonb_to_recordset(COALESCE(p_models, '[]'::jsonb)) AS m(
+        api_endpoint VARCHAR(255),
+        model_name VARCHAR(255),
+        request_count INTEGER,
+        input_tokens BIGINT,
+        output_tokens BIGINT,
+        total_tokens BIGINT,
+        estimated_cost_usd DECIMAL(10, 6)
+    );
+
+    IF jsonb_typeof(p_snapshot->'daily') = 'object' THEN
+        INSERT INTO daily_stats (
+            stat_date, total_requests, success_count, failure_count, total_tokens,
+            estimated_cost_usd, breakdown
+        )
+        SELECT d.stat_date, d.total_requests, d.success_count, d.failure_count, d.total_tokens,
+               d.estimated_cost_usd, COALESCE(d.breakdown, '{}'::jsonb)
+        FROM jsonb_to_record(p_snapshot->'daily') AS d(
+            stat_date DATE,
+            total_requests INTEGER,
+            success_count INTEGER,
+            failure_count INTEGER,
+            total_tokens BIGINT,
+            estimated_cost_usd DECIMAL(10, 6),
+            breakdown JSONB
+        )
+        ON CONFLICT (stat_date) DO UPDATE SET
+            total_requests = EXCLUDED.total_requests,
+            success_count = EXCLUDED.success_count,
+            failure_count = EXCLUDED.failure_count,
+            total_tokens = EXCLUDED.total_tokens,
+            estimated_cost_usd = EXCLUDED.estimated_cost_usd,
+            breakdown = EXCLUDED.breakdown,
+            updated_at = NOW();
+    END IF;
+
+    RETURN jsonb_build_object(
+        'snapshot_id', v_snapshot_id,
+        'cumulative_cost_usd', v_cumulative
+    );
+END;
+$$;
+
+-- Only the collector (service role) may write snapshots through this function
+REVOKE ALL ON FUNCTION store_usage_snapshot(JSONB, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION store_usage_snapshot(JSONB, JSONB) TO service_role;
+
+-- Bumped whenever store_usage_snapshot's payload contract changes; the collector
+-- refuses to start unless the installed version matches the one it writes for
+CREATE OR REPLACE FUNCTION store_usage_snapshot_version()
+RETURNS INTEGER
+LANGUAGE sql
+IMMUTABLE
+AS $$ SELECT 1 $$;
+
+GRANT EXECUTE ON FUNCTION store_usage_snapshot_version() TO service_role;